@@ -1,45 +1,71 @@
 import os
+import re
+
+# Leading indent blocks ('│   ' or 4 spaces), optional branch marker, then the entry
+_INDENT = re.compile(r'^((?:│   |    )*)(?:[├└]── )?(.*)$')
 
 def parse_tree(lines):
-    stack = []
-    result = []
+    # Already-joined path prefixes, one per open directory (plus the root '')
+    path_stack = ['']
     for line in lines:
         # Ignore empty lines and comments
         line = line.rstrip()
         if not line or line.startswith(';'):
             continue
         # Count indentation (spaces or ├──/└──)
-        indent = 0
-        while line.startswith('│   ') or line.startswith('    '):
-            indent += 1
-            line = line[4:]
-        if line.startswith('├── ') or line.startswith('└── '):
-            line = line[4:]
+        m = _INDENT.match(line)
+        indent = len(m.group(1)) // 4
         # Remove annotations in parentheses
-        name = line.split('(')[0].strip()
+        name = m.group(2).split('(')[0].strip()
         # Remove trailing slashes for directories
         is_dir = name.endswith('/')
         name = name.rstrip('/')
         # Adjust stack to current indent
-        while len(stack) > indent:
-            stack.pop()
-        path = os.path.join(*stack, name) if stack else name
-        result.append((path, is_dir))
+        while len(path_stack) > indent + 1:
+            path_stack.pop()
+        path = path_stack[-1] + name
+        yield path, is_dir
         if is_dir:
-            stack.append(name)
-    return result
+            path_stack.append(path + os.sep)
+
+def mkdir_p(path):
+    # Try mkdir blindly and only walk up when the parent is missing; unlike
+    # os.makedirs this skips the stat, so an existing parent costs one syscall
+    try:
+        os.mkdir(path)
+    except FileExistsError:
+        # Only stat on a collision, to reject a file sitting at the path
+        if not os.path.isdir(path):
+            raise
+    except FileNotFoundError:
+        parent = os.path.dirname(path)
+        if not parent or parent == path:
+            raise
+        mkdir_p(parent)
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            if not os.path.isdir(path):
+                raise
+
+def make_dir(dir_path, created):
+    if dir_path in created:
+        return
+    mkdir_p(dir_path)
+    created.add(dir_path)
 
 def create_structure(tree_file, root_dir='.'):
+    # Directories already made, so each one is created only once
+    created = set()
     with open(tree_file, 'r') as f:
-        lines = f.readlines()
-    structure = parse_tree(lines)
-    for path, is_dir in structure:
-        full_path = os.path.join(root_dir, path)
-        if is_dir:
-            os.makedirs(full_path, exist_ok=True)
-        else:
-            os.makedirs(os.path.dirname(full_path), exist_ok=True)
-            open(full_path, 'a').close()
+        for path, is_dir in parse_tree(f):
+            full_path = os.path.join(root_dir, path)
+            if is_dir:
+                make_dir(full_path, created)
+            else:
+                make_dir(os.path.dirname(full_path), created)
+                # Raw open/close, no file object; existing files are left untouched
+                os.close(os.open(full_path, os.O_CREAT | os.O_WRONLY, 0o644))
 
 if __name__ == '__main__':
     # Usage: python create_from_tree.py treeStructure [target_dir]
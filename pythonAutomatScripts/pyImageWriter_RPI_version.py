@@ -8,20 +8,37 @@ import os
 import sys
 import time
 import subprocess
+import shutil
+import signal
 import threading
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
+import ctypes
+import errno
+import queue
+import json
+import fcntl
 from pathlib import Path
-import RPi.GPIO as GPIO
-from pyudev import Context, Monitor, MonitorObserver
+import pigpio
+from pyudev import Context, Devices, Monitor, MonitorObserver
 
 # Configuration
-LED_PIN = 18                     # GPIO pin for LED (PWM capable pin)
+LED_PIN = 18                     # GPIO pin for LED (hardware PWM pin: 12, 13, 18 or 19)
+LED_PWM_FREQ = 1000             # Hardware PWM frequency for steady brightness (Hz)
 IMAGE_PATH = "/path/to/your/image.img"  # Change to your image file path
 MOUNT_DIR = "/mnt/usb"          # Temporary mount directory
 LOG_FILE = "/var/log/usb_writer.log"
 EXPAND_FS = True                # Set to False to skip filesystem expansion
 EXPAND_PARTITION = 2            # Which partition to expand (usually 2 for rootfs)
+IMAGE_PRECHECKED = True         # Image filesystem is known clean, skip e2fsck after writing
+WRITE_CHUNK_SIZE = 64 * 1024 * 1024    # Bytes per sendfile() call
+# Buffers in flight for the pipelined copy; 0 uses sendfile (default). The target
+# is written through the page cache, so kernel writeback already overlaps reads
+# with writes; only enable this if the source device's reads are the bottleneck
+WRITE_PIPELINE_DEPTH = 0
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024    # Size of each pipelined copy buffer
+PROGRESS_INTERVAL = 256 * 1024 * 1024  # Log write progress every N bytes
 
 # Setup logging
 logging.basicConfig(
@@ -33,84 +50,68 @@ logging.basicConfig(
     ]
 )
 
+# umount2() straight from libc, so unmounting needs no umount process
+libc = ctypes.CDLL('libc.so.6', use_errno=True)
+MNT_DETACH = 2
+# ioctl that makes the kernel re-read a partition table (what partprobe issues)
+BLKRRPART = 0x125F
+# mountinfo escapes space, tab, newline and backslash as \ooo octal
+MOUNTINFO_ESCAPE = re.compile(r'\\([0-7]{3})')
+
+def read_sysfs(path):
+    """Read a single sysfs attribute as a stripped string"""
+    with open(path, 'r') as f:
+        return f.read().strip()
+
 class USBCopier:
     def __init__(self):
         self.is_writing = False
         self.device_path = None
-        self.led_thread = None
-        self.stop_led = threading.Event()
         self.expansion_in_progress = False
+        self.udev_context = Context()
+        
+        # The image never changes, so read its partition layout once in the
+        # background; it is ready long before the first write finishes
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.image_info = self.executor.submit(self.inspect_image, IMAGE_PATH)
         
         self.setup_gpio()
         self.setup_directories()
         
     def setup_gpio(self):
-        """Initialize GPIO for LED control"""
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(LED_PIN, GPIO.OUT)
-        self.pwm = GPIO.PWM(LED_PIN, 100)  # 100Hz frequency
-        self.pwm.start(0)  # Start with LED off
+        """Initialize hardware PWM for LED control (needs pigpiod running)"""
+        self.pi = pigpio.pi()
+        if not self.pi.connected:
+            raise RuntimeError("Cannot connect to pigpio daemon (start it with: sudo pigpiod)")
+        self.pi.hardware_PWM(LED_PIN, LED_PWM_FREQ, 0)  # Start with LED off
         
     def setup_directories(self):
         """Create necessary directories"""
         Path(MOUNT_DIR).mkdir(parents=True, exist_ok=True)
         
     def breathing_led(self):
-        """Create breathing LED effect during writing"""
-        while not self.stop_led.is_set():
-            for dc in range(0, 101, 5):  # Fade in
-                if self.stop_led.is_set():
-                    break
-                self.pwm.ChangeDutyCycle(dc)
-                time.sleep(0.05)
-            for dc in range(100, -1, -5):  # Fade out
-                if self.stop_led.is_set():
-                    break
-                self.pwm.ChangeDutyCycle(dc)
-                time.sleep(0.05)
+        """Slow 1Hz pulse during writing, generated by the PWM peripheral"""
+        self.pi.hardware_PWM(LED_PIN, 1, 500000)
     
-    def fast_blink_led(self, duration=5):
-        """Fast blinking LED for expansion process"""
-        start_time = time.time()
-        while time.time() - start_time < duration and not self.stop_led.is_set():
-            self.pwm.ChangeDutyCycle(100)
-            time.sleep(0.2)
-            self.pwm.ChangeDutyCycle(0)
-            time.sleep(0.2)
+    def fast_blink_led(self):
+        """Fast blinking LED (5Hz) for expansion process"""
+        self.pi.hardware_PWM(LED_PIN, 5, 500000)
     
     def solid_led(self, brightness=100):
-        """Set LED to constant brightness"""
-        self.pwm.ChangeDutyCycle(brightness)
+        """Set LED to constant brightness (0-100)"""
+        self.pi.hardware_PWM(LED_PIN, LED_PWM_FREQ, brightness * 10000)
     
     def find_usb_device(self):
         """Find the most recently connected USB storage device"""
         try:
-            # List all block devices
-            result = subprocess.run(
-                ['lsblk', '-o', 'NAME,TYPE,MOUNTPOINT,SIZE,TRAN', '-J'],
-                capture_output=True,
-                text=True
-            )
-            
-            import json
-            devices = json.loads(result.stdout)
-            
-            # Look for USB disks
-            for device in devices['blockdevices']:
-                if device['type'] == 'disk' and device.get('tran') == 'usb':
-                    return f"/dev/{device['name']}", device.get('size', 'Unknown')
-                # Also check if it has 'children' and look for USB in transport
-                if device['type'] == 'disk' and 'children' in device:
-                    # Check sysfs for USB connection
-                    sysfs_path = f"/sys/block/{device['name']}/device"
-                    if os.path.exists(sysfs_path):
-                        # Check if it's USB by looking for vendor/model
-                        vendor_path = f"/sys/block/{device['name']}/device/vendor"
-                        if os.path.exists(vendor_path):
-                            with open(vendor_path, 'r') as f:
-                                vendor = f.read().strip()
-                                if vendor:  # USB devices usually have a vendor
-                                    return f"/dev/{device['name']}", device.get('size', 'Unknown')
+            # Ask udev for whole disks instead of spawning lsblk
+            for device in self.udev_context.list_devices(subsystem='block', DEVTYPE='disk'):
+                if device.get('ID_BUS') != 'usb':
+                    continue
+                # size is always reported in 512-byte sectors
+                size = device.attributes.asint('size') * 512
+                if size:  # Empty card readers report 0
+                    return device.device_node, size
             
             return None, None
             
@@ -118,54 +119,158 @@ class USBCopier:
             logging.error(f"Error finding USB device: {e}")
             return None, None
     
+    def mounted_partitions(self, device_path):
+        """List mount points of the device and its partitions from /proc/self/mountinfo"""
+        mount_points = []
+        with open('/proc/self/mountinfo', 'r') as f:
+            for line in f:
+                # Optional fields end at ' - ', followed by fstype and mount source
+                fields, _, tail = line.partition(' - ')
+                source = tail.split()[1]
+                suffix = source[len(device_path):]
+                if source.startswith(device_path) and (not suffix or suffix.lstrip('p').isdigit()):
+                    mount_point = MOUNTINFO_ESCAPE.sub(
+                        lambda m: chr(int(m.group(1), 8)), fields.split()[4])
+                    mount_points.append(mount_point)
+        return mount_points
+    
     def unmount_device(self, device_path):
         """Unmount all partitions of the device"""
         try:
-            # Unmount any mounted partitions
-            result = subprocess.run(
-                ['umount', f'{device_path}?*', f'{device_path}[0-9]*'],
-                stderr=subprocess.DEVNULL,
-                stdout=subprocess.DEVNULL
-            )
-            time.sleep(1)  # Give time for unmount
+            # Deepest mount points first so nested mounts come off cleanly
+            for mount_point in sorted(self.mounted_partitions(device_path), reverse=True):
+                target = mount_point.encode()
+                if libc.umount2(target, 0) == 0:
+                    logging.info(f"Unmounted {mount_point}")
+                    continue
+                err = ctypes.get_errno()
+                # Detach busy filesystems lazily rather than leave them mounted
+                if err == errno.EBUSY and libc.umount2(target, MNT_DETACH) == 0:
+                    logging.warning(f"{mount_point} busy, detached lazily")
+                    continue
+                logging.error(f"Error unmounting {mount_point}: {os.strerror(ctypes.get_errno())}")
+                return False
             return True
         except Exception as e:
             logging.error(f"Error unmounting device: {e}")
             return False
     
+    def inspect_image(self, image_path):
+        """Read partition layout and filesystem types from the image file itself"""
+        cmd = ['parted', '-sm', image_path, 'unit', 's', 'print']
+        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        
+        # Machine-readable output: 'BYT;', a disk line, then one line per partition
+        # as number:start:end:size:filesystem:name:flags;
+        partitions = []
+        for line in result.stdout.splitlines()[2:]:
+            fields = line.rstrip(';').split(':')
+            partition = {
+                'number': int(fields[0]),
+                'start': int(fields[1].rstrip('s')),
+                'end': int(fields[2].rstrip('s')),
+                'sectors': int(fields[3].rstrip('s')),
+                'fs_type': fields[4]
+            }
+            partitions.append(partition)
+        
+        logging.info(f"Image has {len(partitions)} partition(s)")
+        return partitions
+    
+    def image_partitions(self):
+        """Partition layout from the background image inspection, or None if it failed"""
+        try:
+            return self.image_info.result(timeout=30)
+        except Exception as e:
+            logging.warning(f"Image inspection failed, probing device instead: {e}")
+            return None
+    
     def get_partition_info(self, device_path):
         """Get information about partitions on the device"""
         try:
-            # Use fdisk to list partitions
+            # Partitions show up as /sys/block/<dev>/<dev>N with start/size in sectors
+            dev_name = os.path.basename(device_path)
+            partitions = []
+            
+            for entry in os.scandir(f"/sys/block/{dev_name}"):
+                if not entry.name.startswith(dev_name):
+                    continue
+                try:
+                    number = int(read_sysfs(f"{entry.path}/partition"))
+                except FileNotFoundError:
+                    continue  # Not a partition (e.g. holders, queue)
+                start = int(read_sysfs(f"{entry.path}/start"))
+                sectors = int(read_sysfs(f"{entry.path}/size"))
+                partition = {
+                    'device': f"/dev/{entry.name}",
+                    'number': number,
+                    'start': start,
+                    'end': start + sectors - 1,
+                    'sectors': sectors,
+                    'size': sectors * 512
+                }
+                partitions.append(partition)
+            
+            if not partitions:
+                # Kernel hasn't picked up the table yet, read it from the disk
+                return self.get_partition_info_sfdisk(device_path)
+            
+            partitions.sort(key=lambda p: p['number'])
+            return partitions
+            
+        except Exception as e:
+            logging.error(f"Error getting partition info: {e}")
+            return []
+    
+    def get_partition_info_sfdisk(self, device_path):
+        """Alternative method to read partitions using sfdisk's JSON output"""
+        try:
             result = subprocess.run(
-                ['fdisk', '-l', device_path],
+                ['sfdisk', '-J', device_path],
                 capture_output=True,
                 text=True
             )
+            if result.returncode != 0:
+                logging.error(f"sfdisk failed: {result.stderr}")
+                return []
             
+            table = json.loads(result.stdout)['partitiontable']
+            sector_size = table.get('sectorsize', 512)
             partitions = []
-            lines = result.stdout.split('\n')
-            
-            for line in lines:
-                if re.match(rf'^{device_path}\d', line):
-                    parts = line.split()
-                    if len(parts) >= 5:
-                        partition = {
-                            'device': parts[0],
-                            'start': parts[1],
-                            'end': parts[2],
-                            'sectors': parts[3],
-                            'size': parts[4],
-                            'type': ' '.join(parts[5:]) if len(parts) > 5 else 'Unknown'
-                        }
-                        partitions.append(partition)
             
+            for part in table.get('partitions', []):
+                # Node is the device path plus the number, e.g. /dev/sda2 or /dev/mmcblk0p2
+                number = int(part['node'][len(device_path):].lstrip('p'))
+                partition = {
+                    'device': part['node'],
+                    'number': number,
+                    'start': part['start'],
+                    'end': part['start'] + part['size'] - 1,
+                    'sectors': part['size'],
+                    'size': part['size'] * sector_size,
+                    'type': part.get('type', 'Unknown')
+                }
+                partitions.append(partition)
+            
+            partitions.sort(key=lambda p: p['number'])
             return partitions
             
         except Exception as e:
-            logging.error(f"Error getting partition info: {e}")
+            logging.error(f"Error reading partitions with sfdisk: {e}")
             return []
     
+    def reread_partition_table(self, device_path):
+        """Ask the kernel to re-read the partition table and wait for udev to catch up"""
+        fd = os.open(device_path, os.O_RDONLY)
+        try:
+            fcntl.ioctl(fd, BLKRRPART)
+        except OSError as e:
+            logging.warning(f"Could not re-read partition table of {device_path}: {e}")
+        finally:
+            os.close(fd)
+        # Returns as soon as the new partition nodes are processed
+        subprocess.run(['udevadm', 'settle', '--timeout=5'], check=False)
+    
     def expand_partition(self, device_path, partition_number=2):
         """Expand the partition to fill the entire disk using parted"""
         try:
@@ -176,14 +281,6 @@ class USBCopier:
             result = subprocess.run(cmd_check, capture_output=True, text=True)
             logging.info(f"Current partition layout:\n{result.stdout}")
             
-            # Get disk size in sectors
-            cmd_disk_size = ['blockdev', '--getsz', device_path]
-            result = subprocess.run(cmd_disk_size, capture_output=True, text=True)
-            disk_sectors = int(result.stdout.strip())
-            
-            # Calculate end position (leaving 1MB at the end for safety)
-            end_sector = disk_sectors - 2048  # 1MB = 2048 sectors (512 bytes/sector)
-            
             # Resize partition using parted
             # Note: parted uses MB, not sectors
             cmd_resize = [
@@ -201,8 +298,7 @@ class USBCopier:
                 return self.expand_partition_fdisk(device_path, partition_number)
             
             # Reread partition table
-            subprocess.run(['partprobe', device_path], check=False)
-            time.sleep(2)  # Wait for kernel to update partition table
+            self.reread_partition_table(device_path)
             
             logging.info("Partition expanded successfully")
             return True
@@ -242,8 +338,7 @@ w
                 return False
             
             # Reread partition table
-            subprocess.run(['partprobe', device_path], check=False)
-            time.sleep(3)
+            self.reread_partition_table(device_path)
             
             logging.info("Partition expanded using fdisk")
             return True
@@ -252,29 +347,35 @@ w
             logging.error(f"Error in fdisk expansion: {e}")
             return False
     
-    def expand_filesystem(self, partition_device):
+    def expand_filesystem(self, partition_device, fs_type=None):
         """Expand the filesystem to fill the partition"""
         try:
             logging.info(f"Expanding filesystem on {partition_device}")
             
-            # First, check filesystem type
-            cmd_check_fs = ['blkid', '-o', 'value', '-s', 'TYPE', partition_device]
-            result = subprocess.run(cmd_check_fs, capture_output=True, text=True)
-            fs_type = result.stdout.strip().lower()
+            # First, check filesystem type (already probed by udev, no need for blkid)
+            if not fs_type:  # Unknown to the image inspection too (parted gives '')
+                device = Devices.from_device_file(self.udev_context, partition_device)
+                fs_type = device.get('ID_FS_TYPE', '')
+            fs_type = fs_type.lower()
             
             logging.info(f"Detected filesystem type: {fs_type}")
             
             if fs_type in ['ext2', 'ext3', 'ext4']:
                 # For ext filesystems, use resize2fs
-                # First run fsck to ensure filesystem is clean
-                logging.info("Running filesystem check...")
-                cmd_fsck = ['e2fsck', '-f', '-y', partition_device]
-                result = subprocess.run(cmd_fsck, capture_output=True, text=True)
-                logging.info(f"fsck output: {result.stdout}")
+                if IMAGE_PRECHECKED:
+                    # A freshly written clean image doesn't need a full read-back
+                    # over USB; -f lets resize2fs skip its own fsck requirement
+                    cmd_resize = ['resize2fs', '-f', partition_device]
+                else:
+                    # First run fsck to ensure filesystem is clean
+                    logging.info("Running filesystem check...")
+                    cmd_fsck = ['e2fsck', '-f', '-y', partition_device]
+                    result = subprocess.run(cmd_fsck, capture_output=True, text=True)
+                    logging.info(f"fsck output: {result.stdout}")
+                    cmd_resize = ['resize2fs', partition_device]
                 
                 # Now resize the filesystem
                 logging.info("Resizing filesystem...")
-                cmd_resize = ['resize2fs', partition_device]
                 result = subprocess.run(cmd_resize, capture_output=True, text=True)
                 
                 if result.returncode == 0:
@@ -342,18 +443,19 @@ w
         logging.info("Starting filesystem expansion process")
         
         # Fast blinking LED during expansion
-        expansion_thread = threading.Thread(target=self.fast_blink_led, args=(30,))
-        expansion_thread.start()
+        self.fast_blink_led()
         
         try:
             # Wait a moment for the device to be ready
             time.sleep(3)
             
             # Unmount device first
-            self.unmount_device(device_path)
+            if not self.unmount_device(device_path):
+                logging.error(f"Cannot expand {device_path}: partitions still mounted")
+                return False
             
-            # Get partition info
-            partitions = self.get_partition_info(device_path)
+            # Get partition info, preferring what was read from the image
+            partitions = self.image_partitions() or self.get_partition_info(device_path)
             if not partitions:
                 logging.error("No partitions found to expand")
                 return False
@@ -366,17 +468,16 @@ w
             
             partition_device = f"{device_path}{target_partition}"
             logging.info(f"Target partition for expansion: {partition_device}")
+            fs_type = next((p.get('fs_type') for p in partitions
+                            if p['number'] == target_partition), None)
             
             # Step 1: Expand the partition
             if not self.expand_partition(device_path, target_partition):
                 logging.error("Failed to expand partition")
                 return False
             
-            # Wait for kernel to recognize new partition size
-            time.sleep(2)
-            
             # Step 2: Expand the filesystem
-            if not self.expand_filesystem(partition_device):
+            if not self.expand_filesystem(partition_device, fs_type):
                 logging.error("Failed to expand filesystem")
                 return False
             
@@ -386,8 +487,6 @@ w
             logging.info(f"Final filesystem size:\n{result.stdout}")
             
             self.expansion_in_progress = False
-            self.stop_led.set()
-            expansion_thread.join(timeout=1)
             
             logging.info("Filesystem expansion completed successfully")
             return True
@@ -395,17 +494,101 @@ w
         except Exception as e:
             logging.error(f"Expansion process error: {e}")
             self.expansion_in_progress = False
-            self.stop_led.set()
+            return False
+    
+    def log_progress(self, sent, size, n):
+        """Log write progress whenever the last n bytes crossed a PROGRESS_INTERVAL boundary"""
+        if sent // PROGRESS_INTERVAL != (sent - n) // PROGRESS_INTERVAL:
+            logging.info(f"Write: {sent >> 20} MiB / {size >> 20} MiB "
+                         f"({sent * 100 // size}%)")
+    
+    def copy_sendfile(self, src, dst, size):
+        """Copy with sendfile (kernel-side, no userspace buffers), one chunk at a time"""
+        sent = 0
+        while sent < size:
+            n = os.sendfile(dst.fileno(), src.fileno(), sent,
+                            min(WRITE_CHUNK_SIZE, size - sent))
+            if n == 0:
+                break
+            sent += n
+            self.log_progress(sent, size, n)
+        return sent
+    
+    def copy_pipelined(self, src, dst, size):
+        """Copy through a ring of fixed buffers, reading ahead while earlier chunks are written"""
+        free_buffers = queue.Queue()
+        filled_buffers = queue.Queue()
+        for _ in range(WRITE_PIPELINE_DEPTH):
+            free_buffers.put(bytearray(WRITE_BUFFER_SIZE))
+        
+        def reader():
+            try:
+                while True:
+                    buf = free_buffers.get()
+                    if buf is None:  # Writer gave up
+                        return
+                    n = src.readinto(buf)
+                    filled_buffers.put((buf, n))
+                    if not n:
+                        return
+            except BaseException as e:
+                # Hand every failure to the writer, or it would wait forever
+                filled_buffers.put((None, e))
+        
+        # readinto() and os.write() both release the GIL, so the SD card read
+        # and the USB write run concurrently
+        read_thread = threading.Thread(target=reader, name='image-reader', daemon=True)
+        read_thread.start()
+        
+        sent = 0
+        try:
+            while True:
+                buf, n = filled_buffers.get()
+                if buf is None:
+                    raise n
+                if not n:
+                    break
+                view = memoryview(buf)[:n]
+                while view:  # os.write() may accept less than asked
+                    view = view[os.write(dst.fileno(), view):]
+                sent += n
+                self.log_progress(sent, size, n)
+                free_buffers.put(buf)
+        finally:
+            free_buffers.put(None)
+            read_thread.join()
+        return sent
+    
+    def copy_image(self, device_path):
+        """Copy the image onto the device, pipelined or with sendfile"""
+        try:
+            with open(IMAGE_PATH, 'rb', buffering=0) as src, \
+                    open(device_path, 'wb', buffering=0) as dst:
+                size = os.fstat(src.fileno()).st_size
+                if WRITE_PIPELINE_DEPTH:
+                    sent = self.copy_pipelined(src, dst, size)
+                else:
+                    sent = self.copy_sendfile(src, dst, size)
+                
+                # Flush everything to the device before reporting success
+                logging.info("Flushing written data to the device...")
+                os.fsync(dst.fileno())
+            
+            if sent < size:
+                logging.error(f"Image write stopped early: {sent} of {size} bytes written")
+                return False
+            return True
+            
+        except OSError as e:
+            logging.error(f"Image write failed: {e}")
             return False
     
     def write_image_to_usb(self, device_path):
-        """Write image to USB device using dd"""
+        """Write image to USB device and expand its filesystem"""
         logging.info(f"Starting image write to {device_path}")
         
         # Start breathing LED effect
-        self.stop_led.clear()
-        self.led_thread = threading.Thread(target=self.breathing_led)
-        self.led_thread.start()
+        self.breathing_led()
         
         try:
             # Verify image exists
@@ -414,67 +597,18 @@ w
                 return False
             
             # Unmount device before writing
-            self.unmount_device(device_path)
+            if not self.unmount_device(device_path):
+                logging.error(f"Not writing to {device_path}: partitions still mounted")
+                self.solid_led(0)
+                return False
             
-            # Write image using dd with progress
+            # Write image with progress
             logging.info(f"Writing image {IMAGE_PATH} to {device_path}")
             
-            # Use pv for progress bar if available, otherwise use dd
-            try:
-                # Try to use pv for better progress display
-                cmd = [
-                    'pv', IMAGE_PATH,
-                    '|', 'dd',
-                    f'of={device_path}',
-                    'bs=4M',
-                    'conv=fsync'
-                ]
-                cmd_str = ' '.join(cmd)
-                process = subprocess.Popen(
-                    cmd_str,
-                    shell=True,
-                    executable='/bin/bash',
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True
-                )
-            except:
-                # Fall back to dd with status
-                cmd = [
-                    'dd',
-                    f'if={IMAGE_PATH}',
-                    f'of={device_path}',
-                    'bs=4M',
-                    'status=progress',
-                    'conv=fsync'
-                ]
-                logging.info(f"Executing: {' '.join(cmd)}")
-                process = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True
-                )
-            
-            # Monitor progress
-            for line in process.stdout:
-                if line.strip():
-                    logging.info(f"Write: {line.strip()}")
-            
-            process.wait()
-            
-            if process.returncode == 0:
+            if self.copy_image(device_path):
                 logging.info("Image write completed successfully")
-                
-                # Sync and verify
-                subprocess.run(['sync'], check=True)
                 logging.info("Data synchronized to disk")
                 
-                # Stop breathing LED
-                self.stop_led.set()
-                if self.led_thread:
-                    self.led_thread.join(timeout=2)
-                
                 # Expand filesystem if enabled
                 if EXPAND_FS:
                     # Solid yellow LED (50%) during expansion
@@ -514,9 +648,7 @@ w
                 
                 return True
             else:
-                logging.error(f"Image write failed with code: {process.returncode}")
                 # Set LED to error pattern (fast blinking)
-                self.stop_led.set()
                 for _ in range(10):
                     self.solid_led(100)
                     time.sleep(0.1)
@@ -526,7 +658,7 @@ w
                 
         except Exception as e:
             logging.error(f"Error during image write: {e}")
-            self.stop_led.set()
+            self.solid_led(0)
             return False
     
     def handle_usb_insertion(self):
@@ -542,7 +674,7 @@ w
         device_path, size = self.find_usb_device()
         
         if device_path:
-            logging.info(f"Found USB device: {device_path} (Size: {size})")
+            logging.info(f"Found USB device: {device_path} (Size: {size / 1e9:.1f} GB)")
             
             # Display warning about data loss
             logging.warning(f"WARNING: All data on {device_path} will be destroyed!")
@@ -576,8 +708,9 @@ w
     
     def udev_monitor(self):
         """Monitor for USB insertion events using udev"""
-        context = Context()
-        monitor = Monitor.from_netlink(context)
+        # Own context: libudev contexts must not be used from several threads at
+        # once, and the observer thread runs alongside the insertion handlers
+        monitor = Monitor.from_netlink(Context())
         monitor.filter_by(subsystem='block', device_type='disk')
         
         observer = MonitorObserver(
@@ -590,8 +723,9 @@ w
         observer.start()
         
         try:
+            # The observer has its own thread; sleep until a signal arrives
             while True:
-                time.sleep(1)
+                signal.pause()
         except KeyboardInterrupt:
             observer.stop()
             observer.join()
@@ -609,13 +743,13 @@ w
                 thread.start()
     
     def cleanup(self):
-        """Clean up resources"""
+        """Clean up resources (safe to call more than once)"""
+        if not self.pi.connected:  # Already cleaned up; pi.stop() clears this
+            return
         logging.info("Cleaning up...")
-        self.stop_led.set()
-        if self.led_thread:
-            self.led_thread.join(timeout=1)
-        self.pwm.stop()
-        GPIO.cleanup()
+        self.executor.shutdown(wait=False)
+        self.pi.hardware_PWM(LED_PIN, 0, 0)
+        self.pi.stop()
         logging.info("Cleanup completed")
 
 def main():
@@ -632,12 +766,7 @@ def main():
     
     # Check for required tools
     required_tools = ['parted', 'fdisk', 'e2fsck', 'resize2fs']
-    missing_tools = []
-    
-    for tool in required_tools:
-        result = subprocess.run(['which', tool], capture_output=True)
-        if result.returncode != 0:
-            missing_tools.append(tool)
+    missing_tools = [tool for tool in required_tools if shutil.which(tool) is None]
     
     if missing_tools:
         print(f"Missing required tools: {', '.join(missing_tools)}")